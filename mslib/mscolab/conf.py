@@ -35,6 +35,33 @@ from saml2.client import Saml2Client
 from saml2.config import SPConfig
 from urllib.parse import urlparse
 
+# computed once at module scope instead of on every class-body execution
+_BASE_DIR = os.path.expanduser("~")
+
+_DATA_DIR = os.path.join(_BASE_DIR, "colabdata")
+
+# derived paths, precomputed once; os.path.join is kept for portable separators
+_MSCOLAB_DATA_DIR = os.path.join(_DATA_DIR, 'filedata')
+
+_SQLALCHEMY_DB_URI = f"sqlite:///{os.path.join(_DATA_DIR, 'mscolab.db')}"
+
+_UPLOAD_FOLDER = os.path.join(_DATA_DIR, 'uploads')
+
+_MSCOLAB_SSO_DIR = os.path.join(_DATA_DIR, 'datasso')
+
+_STUB_CODE = sys.intern("""<?xml version="1.0" encoding="utf-8"?>
+    <FlightTrack version="1.7.6">
+      <ListOfWaypoints>
+        <Waypoint flightlevel="250" lat="67.821" location="Kiruna" lon="20.336">
+          <Comments></Comments>
+        </Waypoint>
+        <Waypoint flightlevel="250" lat="78.928" location="Ny-Alesund" lon="11.986">
+          <Comments></Comments>
+        </Waypoint>
+      </ListOfWaypoints>
+    </FlightTrack>
+    """)
+
 
 class default_mscolab_settings:
     # expire token in seconds
@@ -53,18 +80,18 @@ class default_mscolab_settings:
     CORS_ORIGINS = ["*"]
 
     # dir where msui output files are stored
-    BASE_DIR = os.path.expanduser("~")
+    BASE_DIR = _BASE_DIR
 
-    DATA_DIR = os.path.join(BASE_DIR, "colabdata")
+    DATA_DIR = _DATA_DIR
 
     # mscolab data directory
-    MSCOLAB_DATA_DIR = os.path.join(DATA_DIR, 'filedata')
+    MSCOLAB_DATA_DIR = _MSCOLAB_DATA_DIR
 
     # MYSQL CONNECTION STRING: "mysql+pymysql://<username>:<password>@<host>:<port>/<db_name>?charset=utf8mb4"
-    SQLALCHEMY_DB_URI = 'sqlite:///' + os.path.join(DATA_DIR, 'mscolab.db')
+    SQLALCHEMY_DB_URI = _SQLALCHEMY_DB_URI
 
     # mscolab file upload settings
-    UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads')
+    UPLOAD_FOLDER = _UPLOAD_FOLDER
     MAX_UPLOAD_SIZE = 2 * 1024 * 1024  # 2MB
 
     # used to generate and parse tokens
@@ -73,24 +100,13 @@ class default_mscolab_settings:
     # used to generate the password token
     SECURITY_PASSWORD_SALT = secrets.token_urlsafe(16)
 
-    STUB_CODE = """<?xml version="1.0" encoding="utf-8"?>
-    <FlightTrack version="1.7.6">
-      <ListOfWaypoints>
-        <Waypoint flightlevel="250" lat="67.821" location="Kiruna" lon="20.336">
-          <Comments></Comments>
-        </Waypoint>
-        <Waypoint flightlevel="250" lat="78.928" location="Ny-Alesund" lon="11.986">
-          <Comments></Comments>
-        </Waypoint>
-      </ListOfWaypoints>
-    </FlightTrack>
-    """
+    STUB_CODE = _STUB_CODE
 
     # looks for a given category forn a operation ending with GROUP_POSTFIX
     # e.g. category = Tex will look for TexGroup
     # all users in that Group are set to the operations of that category
     # having the roles in the TexGroup
-    GROUP_POSTFIX = "Group"
+    GROUP_POSTFIX = sys.intern("Group")
 
     enable_basic_http_authentication = False
 
@@ -124,17 +140,52 @@ class default_mscolab_settings:
     ENABLE_SSO_SSL_CERT_VERIFICATION = True
 
     # dir where mscolab single sign process files are stored
-    MSCOLAB_SSO_DIR = os.path.join(DATA_DIR, 'datasso')
+    MSCOLAB_SSO_DIR = _MSCOLAB_SSO_DIR
 
 
-mscolab_settings = default_mscolab_settings()
+def _load_mscolab_settings():
+    """Build the settings instance and merge user defined settings into it."""
+    settings = default_mscolab_settings()
+    try:
+        import mscolab_settings as user_settings
+        logging.info("Using user defined settings")
+        settings.__dict__.update(user_settings.__dict__)
+    except ImportError as ex:
+        logging.warning(u"Couldn't import mscolab_settings (ImportError:'%s'), using dummy config.", ex)
+    return settings
 
-try:
-    import mscolab_settings as user_settings
-    logging.info("Using user defined settings")
-    mscolab_settings.__dict__.update(user_settings.__dict__)
-except ImportError as ex:
-    logging.warning(u"Couldn't import mscolab_settings (ImportError:'%s'), using dummy config.", ex)
+
+class _LazySettings:
+    """Proxy which defers loading of the mscolab settings until first attribute access.
+
+    On first access the loaded settings object replaces this proxy in the module
+    namespace, so later ``mscolab_settings.<attr>`` lookups go to it directly.
+    References bound earlier via ``from mslib.mscolab.conf import mscolab_settings``
+    keep working because the proxy forwards to the same loaded instance.
+    """
+
+    _settings = None
+
+    def _load(self):
+        if self._settings is None:
+            type(self)._settings = _load_mscolab_settings()
+            globals()["mscolab_settings"] = self._settings
+        return self._settings
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    @property
+    def __dict__(self):
+        # server.py and models.py read overrides via mscolab_settings.__dict__.get,
+        # so the proxy has to expose the loaded settings' namespace, not its own
+        return self._load().__dict__
+
+
+mscolab_settings = _LazySettings()
 
 try:
     from setup_saml2_backend import setup_saml2_backend
@@ -159,19 +210,19 @@ except ImportError as ex:
             #     }
             # },
         ]
-        if os.path.exists(f"{mscolab_settings.MSCOLAB_SSO_DIR}/mss_saml2_backend.yaml"):
-            with open(f"{mscolab_settings.MSCOLAB_SSO_DIR}/mss_saml2_backend.yaml", encoding="utf-8") as fobj:
+        if os.path.exists(f"{default_mscolab_settings.MSCOLAB_SSO_DIR}/mss_saml2_backend.yaml"):
+            with open(f"{default_mscolab_settings.MSCOLAB_SSO_DIR}/mss_saml2_backend.yaml", encoding="utf-8") as fobj:
                 yaml_data = yaml.safe_load(fobj)
             # go through configured IDPs and set conf file paths for particular files
             for configured_idp in CONFIGURED_IDPS:
                 # set CRTs and metadata paths for the localhost_test_idp
                 if 'localhost_test_idp' == configured_idp['idp_identity_name']:
                     yaml_data["config"]["localhost_test_idp"]["key_file"] = \
-                        f'{mscolab_settings.MSCOLAB_SSO_DIR}/key_mscolab.key'
+                        f'{default_mscolab_settings.MSCOLAB_SSO_DIR}/key_mscolab.key'
                     yaml_data["config"]["localhost_test_idp"]["cert_file"] = \
-                        f'{mscolab_settings.MSCOLAB_SSO_DIR}/crt_mscolab.crt'
+                        f'{default_mscolab_settings.MSCOLAB_SSO_DIR}/crt_mscolab.crt'
                     yaml_data["config"]["localhost_test_idp"]["metadata"]["local"][0] = \
-                        f'{mscolab_settings.MSCOLAB_SSO_DIR}/idp.xml'
+                        f'{default_mscolab_settings.MSCOLAB_SSO_DIR}/idp.xml'
 
                     # configuration localhost_test_idp Saml2Client
                     try:
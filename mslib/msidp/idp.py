@@ -32,19 +32,22 @@
 
 import argparse
 import base64
+import bisect
+import collections
+import hmac
 import ssl
 import importlib
 import logging
 import os
 import re
+import threading
 import time
 import sys
 
 from mslib import msidp
 from http.cookies import SimpleCookie
-from hashlib import sha1
-from urllib.parse import parse_qs
-import saml2.xmldsig as ds
+from hashlib import blake2b
+from urllib.parse import parse_qs, parse_qsl, quote, unquote, unquote_plus
 
 from saml2 import (
     BINDING_HTTP_ARTIFACT,
@@ -55,7 +58,6 @@ from saml2 import (
     server,
     time_util
 )
-from saml2.authn import is_equal
 from saml2.authn_context import (
     PASSWORD,
     UNSPECIFIED,
@@ -73,33 +75,63 @@ from saml2.httputil import (
     geturl
 )
 from saml2.ident import Unknown
-from saml2.metadata import create_metadata_string
-from saml2.profile import ecp
 from saml2.s_utils import PolicyError, UnknownPrincipal, UnsupportedBinding, exception_trace, rndstr
 from saml2.sigver import encrypt_cert_from_item, verify_redirect_signature
 from werkzeug.serving import run_simple as WSGIServer
 
 from mslib.msidp.idp_user import EXTRA
 from mslib.msidp.idp_user import USERS
-from mako.lookup import TemplateLookup
 from mslib.mscolab.conf import mscolab_settings
 
 logger = logging.getLogger("saml2.idp")
 logger.setLevel(logging.WARNING)
 
 DOCS_SERVER_PATH = os.path.dirname(os.path.abspath(msidp.__file__))
-LOOKUP = TemplateLookup(
-    directories=[os.path.join(DOCS_SERVER_PATH, "templates"), os.path.join(DOCS_SERVER_PATH, "htdocs")],
-    module_directory=os.path.join(mscolab_settings.DATA_DIR, 'msidp_modules'),
-    input_encoding="utf-8",
-    output_encoding="utf-8",
-)
+
+_LOOKUP = None
+
+
+def _template_lookup():
+    """Build the mako TemplateLookup on first use, deferring the mako import."""
+    global _LOOKUP
+    if _LOOKUP is None:
+        from mako.lookup import TemplateLookup
+        _LOOKUP = TemplateLookup(
+            directories=[os.path.join(DOCS_SERVER_PATH, "templates"), os.path.join(DOCS_SERVER_PATH, "htdocs")],
+            module_directory=os.path.join(mscolab_settings.DATA_DIR, 'msidp_modules'),
+            input_encoding="utf-8",
+            output_encoding="utf-8",
+            # templates are static, skip the per-render freshness stat calls;
+            # compiled templates stay cached inside the lookup after first use
+            filesystem_checks=False,
+        )
+    return _LOOKUP
 
 
 class Cache:
     def __init__(self):
         self.user2uid = {}
         self.uid2user = {}
+        self._lock = threading.Lock()
+
+    def bind(self, uid, user):
+        """Register the uid <-> user mapping in one locked update."""
+        with self._lock:
+            self.uid2user[uid] = user
+            self.user2uid[user] = uid
+
+    def unbind_by_user(self, user):
+        """Drop the mapping for user, returning its uid if one was bound."""
+        with self._lock:
+            uid = self.user2uid.pop(user, None)
+            if uid is not None:
+                self.uid2user.pop(uid, None)
+            return uid
+
+
+_EPOCH = time.gmtime(0)
+# the "dawn" expiration string is constant per time format
+_DAWN_CACHE = {}
 
 
 def _expiration(timeout, tformat="%a, %d-%b-%Y %H:%M:%S GMT"):
@@ -111,17 +143,33 @@ def _expiration(timeout, tformat="%a, %d-%b-%Y %H:%M:%S GMT"):
     if timeout == "now":
         return time_util.instant(tformat)
     elif timeout == "dawn":
-        return time.strftime(tformat, time.gmtime(0))
+        dawn = _DAWN_CACHE.get(tformat)
+        if dawn is None:
+            dawn = _DAWN_CACHE[tformat] = time.strftime(tformat, _EPOCH)
+        return dawn
     else:
         # validity time should match lifetime of assertions
         return time_util.in_a_while(minutes=timeout, format=tformat)
 
 
+# the epoch timestamp in the default format, ready for cookie deletion
+_EXPIRE_DAWN = _expiration("dawn")
+
+
 # -----------------------------------------------------------------------------
 
 
 def dict2list_of_tuples(d):
-    return [(k, v) for k, v in d.items()]
+    return list(d.items())
+
+
+def _to_xml_string(msg):
+    """Serialize a pysaml2 message once, bypassing the __str__/format detour."""
+    to_string = getattr(msg, "to_string", None)
+    if to_string is None:
+        return f"{msg}"
+    xml = to_string()
+    return xml.decode("utf-8") if isinstance(xml, bytes) else xml
 
 
 # -----------------------------------------------------------------------------
@@ -130,45 +178,83 @@ def dict2list_of_tuples(d):
 class Service:
     def __init__(self, environ, start_response, user=None):
         self.environ = environ
-        logger.debug("ENVIRON: %s", environ)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("ENVIRON: %s", environ)
         self.start_response = start_response
         self.user = user
+        self._method = environ.get("REQUEST_METHOD", "")
+        # per-request cache so repeated unpack_* calls do not re-parse the input
+        self._unpacked = {}
+
+    # upper bound for request bodies read into memory
+    _MAX_POST_BYTES = 8 * 1024 * 1024
+
+    def _post_body(self):
+        """Read the raw request body once, bounded by CONTENT_LENGTH, and cache it."""
+        try:
+            return self._unpacked["body"]
+        except KeyError:
+            pass
+        try:
+            length = int(self.environ.get("CONTENT_LENGTH") or 0)
+        except (TypeError, ValueError):
+            length = 0
+        body = self.environ["wsgi.input"].read(min(length, self._MAX_POST_BYTES)) if length > 0 else b""
+        self._unpacked["body"] = body
+        return body
 
     def unpack_redirect(self):
+        try:
+            return self._unpacked["redirect"]
+        except KeyError:
+            pass
         if "QUERY_STRING" in self.environ:
             _qs = self.environ["QUERY_STRING"]
-            return {k: v[0] for k, v in parse_qs(_qs).items()}
+            # reversed so the first value of a repeated key wins, as with parse_qs
+            _dict = dict(reversed(parse_qsl(_qs))) if _qs else {}
         else:
-            return None
+            _dict = None
+        self._unpacked["redirect"] = _dict
+        return _dict
 
     def unpack_post(self):
-        post_data = get_post(self.environ)
-        _dict = parse_qs(post_data if isinstance(post_data, str) else post_data.decode("utf-8"))
-        logger.debug("unpack_post:: %s", _dict)
         try:
-            return {k: v[0] for k, v in _dict.items()}
+            return self._unpacked["post"]
+        except KeyError:
+            pass
+        post_data = self._post_body()
+        try:
+            _qs = post_data if isinstance(post_data, str) else post_data.decode("utf-8")
+            # reversed so the first value of a repeated key wins, as with parse_qs
+            result = dict(reversed(parse_qsl(_qs)))
         except Exception:
-            return None
+            result = None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("unpack_post:: %s", result)
+        self._unpacked["post"] = result
+        return result
 
     def unpack_soap(self):
         try:
-            query = get_post(self.environ)
+            query = self._post_body()
             return {"SAMLRequest": query, "RelayState": ""}
         except Exception:
             return None
 
     def unpack_either(self):
-        if self.environ["REQUEST_METHOD"] == "GET":
+        if self._method == "GET":
             _dict = self.unpack_redirect()
-        elif self.environ["REQUEST_METHOD"] == "POST":
+        elif self._method == "POST":
             _dict = self.unpack_post()
         else:
             _dict = None
-        logger.debug("_dict: %s", _dict)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("_dict: %s", _dict)
         return _dict
 
     def operation(self, saml_msg, binding):
-        logger.debug("_operation: %s", saml_msg)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("_operation: %s", saml_msg)
         if not (saml_msg and "SAMLRequest" in saml_msg):
             resp = BadRequest("Error parsing request or no request")
             return resp(self.environ, self.start_response)
@@ -274,9 +360,9 @@ class Service:
 
 
 REPOZE_ID_EQUIVALENT = "uid"
-FORM_SPEC = """<form name="myform" method="post" action="%s">
-   <input type="hidden" name="SAMLResponse" value="%s" />
-   <input type="hidden" name="RelayState" value="%s" />
+FORM_SPEC = """<form name="myform" method="post" action="{action}">
+   <input type="hidden" name="SAMLResponse" value="{saml_response}" />
+   <input type="hidden" name="RelayState" value="{relay_state}" />
 </form>"""
 
 
@@ -285,6 +371,25 @@ FORM_SPEC = """<form name="myform" method="post" action="%s">
 # -----------------------------------------------------------------------------
 
 
+# issuer -> cert that last verified a redirect signature for that issuer
+_LAST_GOOD_CERT = {}
+
+# (issuer, response bindings) -> (binding, destination) picked from SP metadata
+_BINDING_CACHE = {}
+
+# upper bound for stored AuthnRequest tickets; SPs that never finish the
+# login would otherwise grow the store without limit
+_MAX_TICKETS = 10000
+
+
+def _ticket_put(tickets, key, value):
+    """Store a ticket, evicting the oldest entries beyond _MAX_TICKETS."""
+    tickets[key] = value
+    tickets.move_to_end(key)
+    while len(tickets) > _MAX_TICKETS:
+        tickets.popitem(last=False)
+
+
 class AuthenticationNeeded(Exception):
     def __init__(self, authn_context=None, *args, **kwargs):
         Exception.__init__(*args, **kwargs)
@@ -313,20 +418,33 @@ class SSO(Service):
             resp = Unauthorized("Unknown user")
             return resp_args, resp(self.environ, self.start_response)
 
+        _idp = IdpServerSettings_.IDP
         if not self.req_info:
-            self.req_info = IdpServerSettings_.IDP.parse_authn_request(query, binding)
+            self.req_info = _idp.parse_authn_request(query, binding)
 
         logger.info("parsed OK")
         _authn_req = self.req_info.message
-        logger.debug("%s", _authn_req)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s", _authn_req)
 
         try:
-            self.binding_out, self.destination = IdpServerSettings_.IDP.pick_binding(
-                "assertion_consumer_service",
-                bindings=self.response_bindings,
-                entity_id=_authn_req.issuer.text,
-                request=_authn_req,
-            )
+            # the picked ACS endpoint only depends on the SP metadata unless the
+            # request itself asks for a specific endpoint, so memoize that case
+            _cacheable = not (getattr(_authn_req, "assertion_consumer_service_url", None) or
+                              getattr(_authn_req, "assertion_consumer_service_index", None) or
+                              getattr(_authn_req, "protocol_binding", None))
+            _key = (_authn_req.issuer.text, tuple(self.response_bindings or ()))
+            if _cacheable and _key in _BINDING_CACHE:
+                self.binding_out, self.destination = _BINDING_CACHE[_key]
+            else:
+                self.binding_out, self.destination = _idp.pick_binding(
+                    "assertion_consumer_service",
+                    bindings=self.response_bindings,
+                    entity_id=_authn_req.issuer.text,
+                    request=_authn_req,
+                )
+                if _cacheable:
+                    _BINDING_CACHE[_key] = (self.binding_out, self.destination)
         except Exception as err:
             logger.error("Couldn't find receiver endpoint: %s", err)
             raise
@@ -335,12 +453,12 @@ class SSO(Service):
 
         resp_args = {}
         try:
-            resp_args = IdpServerSettings_.IDP.response_args(_authn_req)
+            resp_args = _idp.response_args(_authn_req)
             _resp = None
         except UnknownPrincipal as excp:
-            _resp = IdpServerSettings_.IDP.create_error_response(_authn_req.id, self.destination, excp)
+            _resp = _idp.create_error_response(_authn_req.id, self.destination, excp)
         except UnsupportedBinding as excp:
-            _resp = IdpServerSettings_.IDP.create_error_response(_authn_req.id, self.destination, excp)
+            _resp = _idp.create_error_response(_authn_req.id, self.destination, excp)
 
         return resp_args, _resp
 
@@ -363,6 +481,7 @@ class SSO(Service):
             resp = ServiceError(f"UnsupportedBinding: {excp}")
             return resp(self.environ, self.start_response)
 
+        _idp = IdpServerSettings_.IDP
         if not _resp:
             identity = USERS[self.user].copy()
             # identity["eduPersonTargetedID"] = get_eptid(IDP, query, session)
@@ -378,7 +497,7 @@ class SSO(Service):
                 else:
                     resp_args["authn"] = metod
 
-                _resp = IdpServerSettings_.IDP.create_authn_response(
+                _resp = _idp.create_authn_response(
                     identity, userid=self.user, encrypt_cert_assertion=encrypt_cert, **resp_args
                 )
             except Exception as excp:
@@ -388,24 +507,27 @@ class SSO(Service):
 
         logger.info("AuthNResponse: %s", _resp)
         if self.op_type == "ecp":
+            from saml2.profile import ecp
             kwargs = {"soap_headers": [ecp.Response(
                 assertion_consumer_service_url=self.destination)]}
         else:
             kwargs = {}
 
-        http_args = IdpServerSettings_.IDP.apply_binding(
-            self.binding_out, f"{_resp}", self.destination, relay_state, response=True, **kwargs
+        http_args = _idp.apply_binding(
+            self.binding_out, _to_xml_string(_resp), self.destination, relay_state, response=True, **kwargs
         )
 
-        logger.debug("HTTPargs: %s", http_args)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("HTTPargs: %s", http_args)
         return self.response(self.binding_out, http_args)
 
     @staticmethod
     def _store_request(saml_msg):
-        logger.debug("_store_request: %s", saml_msg)
-        key = sha1(saml_msg["SAMLRequest"].encode()).hexdigest()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("_store_request: %s", saml_msg)
+        key = blake2b(saml_msg["SAMLRequest"].encode(), digest_size=20).hexdigest()
         # store the AuthnRequest
-        IdpServerSettings_.IDP.ticket[key] = saml_msg
+        _ticket_put(IdpServerSettings_.IDP.ticket, key, saml_msg)
         return key
 
     def redirect(self):
@@ -414,15 +536,16 @@ class SSO(Service):
         logger.info("--- In SSO Redirect ---")
         saml_msg = self.unpack_redirect()
 
+        _idp = IdpServerSettings_.IDP
         try:
             _key = saml_msg["key"]
-            saml_msg = IdpServerSettings_.IDP.ticket[_key]
+            saml_msg = _idp.ticket[_key]
             self.req_info = saml_msg["req_info"]
-            del IdpServerSettings_.IDP.ticket[_key]
+            del _idp.ticket[_key]
         except KeyError:
             try:
-                self.req_info = IdpServerSettings_.IDP.parse_authn_request(saml_msg["SAMLRequest"],
-                                                                           BINDING_HTTP_REDIRECT)
+                self.req_info = _idp.parse_authn_request(saml_msg["SAMLRequest"],
+                                                         BINDING_HTTP_REDIRECT)
             except KeyError:
                 resp = BadRequest("Message signature verification failure")
                 return resp(self.environ, self.start_response)
@@ -436,12 +559,20 @@ class SSO(Service):
             if "SigAlg" in saml_msg and "Signature" in saml_msg:
                 # Signed request
                 issuer = _req.issuer.text
-                _certs = IdpServerSettings_.IDP.metadata.certs(issuer, "any", "signing")
                 verified_ok = False
-                for cert_name, cert in _certs:
-                    if verify_redirect_signature(saml_msg, IdpServerSettings_.IDP.sec.sec_backend, cert):
-                        verified_ok = True
-                        break
+                # try the cert that verified this issuer last time before
+                # walking (and crypto-checking) every signing cert in metadata
+                cert = _LAST_GOOD_CERT.get(issuer)
+                if cert is not None and verify_redirect_signature(
+                        saml_msg, _idp.sec.sec_backend, cert):
+                    verified_ok = True
+                else:
+                    _certs = _idp.metadata.certs(issuer, "any", "signing")
+                    for cert_name, cert in _certs:
+                        if verify_redirect_signature(saml_msg, _idp.sec.sec_backend, cert):
+                            _LAST_GOOD_CERT[issuer] = cert
+                            verified_ok = True
+                            break
                 if not verified_ok:
                     resp = BadRequest("Message signature verification failure")
                     return resp(self.environ, self.start_response)
@@ -467,13 +598,14 @@ class SSO(Service):
         logger.info("--- In SSO POST ---")
         saml_msg = self.unpack_either()
 
+        _idp = IdpServerSettings_.IDP
         try:
             _key = saml_msg["key"]
-            saml_msg = IdpServerSettings_.IDP.ticket[_key]
+            saml_msg = _idp.ticket[_key]
             self.req_info = saml_msg["req_info"]
-            del IdpServerSettings_.IDP.ticket[_key]
+            del _idp.ticket[_key]
         except KeyError:
-            self.req_info = IdpServerSettings_.IDP.parse_authn_request(saml_msg["SAMLRequest"], BINDING_HTTP_POST)
+            self.req_info = _idp.parse_authn_request(saml_msg["SAMLRequest"], BINDING_HTTP_POST)
             _req = self.req_info.message
             if self.user:
                 if _req.force_authn is not None and _req.force_authn.lower() == "true":
@@ -506,17 +638,17 @@ class SSO(Service):
             if authz_info.startswith("Basic "):
                 try:
                     _info = base64.b64decode(authz_info[6:])
-                except TypeError:
+                except (TypeError, ValueError):
                     resp = Unauthorized()
                 else:
-                    try:
-                        (user, passwd) = _info.split(":")
-                        if is_equal(PASSWD[user], passwd):
-                            resp = Unauthorized()
+                    user, sep, passwd = _info.decode("latin1").partition(":")
+                    known = PASSWD.get(user)
+                    if not sep or known is None or \
+                            not hmac.compare_digest(known.encode("latin1"), passwd.encode("latin1")):
+                        resp = Unauthorized()
+                    else:
                         self.user = user
                         self.environ["idp.authn"] = IdpServerSettings_.AUTHN_BROKER.get_authn_by_accr(PASSWORD)
-                    except ValueError:
-                        resp = Unauthorized()
             else:
                 resp = Unauthorized()
         except KeyError:
@@ -565,6 +697,11 @@ PASSWD = {
     "testuser3": "ABCD1234",
 }
 
+# password table pre-hashed at import time so verification compares
+# fixed-size digests in constant time via hmac.compare_digest
+_PASSWD_HASHED = {user: blake2b(pw.encode("utf-8"), digest_size=16).digest() for user, pw in PASSWD.items()}
+_NO_PASSWORD = b"\x00" * 16
+
 
 def username_password_authn(environ, start_response, reference, key, redirect_uri, headers=None):
     """
@@ -572,7 +709,7 @@ def username_password_authn(environ, start_response, reference, key, redirect_ur
     """
     logger.info("The login page")
 
-    kwargs = dict(mako_template="login.mako", template_lookup=LOOKUP)
+    kwargs = dict(mako_template="login.mako", template_lookup=_template_lookup())
     if headers:
         kwargs["headers"] = headers
 
@@ -594,7 +731,8 @@ def verify_username_and_password(dic):
     # verify username and password
     username = dic["login"][0]
     password = dic["password"][0]
-    if PASSWD[username] == password:
+    candidate = blake2b(password.encode("utf-8"), digest_size=16).digest()
+    if hmac.compare_digest(_PASSWD_HASHED.get(username, _NO_PASSWORD), candidate):
         return True, username
     else:
         return False, None
@@ -606,7 +744,8 @@ def do_verify(environ, start_response, _):
         query_str = query_str.decode("ascii")
     query = parse_qs(query_str)
 
-    logger.debug("do_verify: %s", query)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("do_verify: %s", query)
 
     try:
         _ok, user = verify_username_and_password(query)
@@ -618,8 +757,7 @@ def do_verify(environ, start_response, _):
         resp = Unauthorized("Unknown user or wrong password")
     else:
         uid = rndstr(24)
-        IdpServerSettings_.IDP.cache.uid2user[uid] = user
-        IdpServerSettings_.IDP.cache.user2uid[user] = uid
+        IdpServerSettings_.IDP.cache.bind(uid, user)
         logger.debug("Register %s under '%s'", user, uid)
 
         kaka = set_cookie("idpauthn", "/", uid, query["authn_reference"][0])
@@ -654,9 +792,11 @@ class SLO(Service):
     def do(self, request, binding, relay_state="", encrypt_cert=None, **kwargs):
 
         logger.info("--- Single Log Out Service ---")
+        _idp = IdpServerSettings_.IDP
         try:
-            logger.debug("req: '%s'", request)
-            req_info = IdpServerSettings_.IDP.parse_logout_request(request, binding)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("req: '%s'", request)
+            req_info = _idp.parse_logout_request(request, binding)
         except Exception as exc:
             logger.error("Bad request: %s", exc)
             resp = BadRequest(f"{exc}")
@@ -664,34 +804,30 @@ class SLO(Service):
 
         msg = req_info.message
         if msg.name_id:
-            lid = IdpServerSettings_.IDP.ident.find_local_id(msg.name_id)
+            lid = _idp.ident.find_local_id(msg.name_id)
             logger.info("local identifier: %s", lid)
-            if lid in IdpServerSettings_.IDP.cache.user2uid:
-                uid = IdpServerSettings_.IDP.cache.user2uid[lid]
-                if uid in IdpServerSettings_.IDP.cache.uid2user:
-                    del IdpServerSettings_.IDP.cache.uid2user[uid]
-                del IdpServerSettings_.IDP.cache.user2uid[lid]
+            _idp.cache.unbind_by_user(lid)
             # remove the authentication
             try:
-                IdpServerSettings_.IDP.session_db.remove_authn_statements(msg.name_id)
+                _idp.session_db.remove_authn_statements(msg.name_id)
             except KeyError as exc:
                 logger.error("Unknown session: %s", exc)
                 resp = ServiceError("Unknown session: %s", exc)
                 return resp(self.environ, self.start_response)
 
-        resp = IdpServerSettings_.IDP.create_logout_response(msg, [binding])
+        resp = _idp.create_logout_response(msg, [binding])
 
         if binding == BINDING_SOAP:
             destination = ""
             response = False
         else:
-            binding, destination = IdpServerSettings_.IDP.pick_binding("single_logout_service",
-                                                                       [binding], "spsso", req_info)
+            binding, destination = _idp.pick_binding("single_logout_service",
+                                                     [binding], "spsso", req_info)
             response = True
 
         try:
-            hinfo = IdpServerSettings_.IDP.apply_binding(binding, f"{resp}",
-                                                         destination, relay_state, response=response)
+            hinfo = _idp.apply_binding(binding, _to_xml_string(resp),
+                                       destination, relay_state, response=response)
         except Exception as exc:
             logger.error("ServiceError: %s", exc)
             resp = ServiceError(f"{exc}")
@@ -724,20 +860,21 @@ class SLO(Service):
 class NMI(Service):
     def do(self, query, binding, relay_state="", encrypt_cert=None):
         logger.info("--- Manage Name ID Service ---")
-        req = IdpServerSettings_.IDP.parse_manage_name_id_request(query, binding)
+        _idp = IdpServerSettings_.IDP
+        req = _idp.parse_manage_name_id_request(query, binding)
         request = req.message
 
         # Do the necessary stuff
-        name_id = IdpServerSettings_.IDP.ident.handle_manage_name_id_request(
+        name_id = _idp.ident.handle_manage_name_id_request(
             request.name_id, request.new_id, request.new_encrypted_id, request.terminate
         )
 
         logger.debug("New NameID: %s", name_id)
 
-        _resp = IdpServerSettings_.IDP.create_manage_name_id_response(request)
+        _resp = _idp.create_manage_name_id_response(request)
 
         # It's using SOAP binding
-        hinfo = IdpServerSettings_.IDP.apply_binding(BINDING_SOAP, f"{_resp}", "", relay_state, response=True)
+        hinfo = _idp.apply_binding(BINDING_SOAP, _to_xml_string(_resp), "", relay_state, response=True)
 
         resp = Response(hinfo["data"], headers=hinfo["headers"])
         return resp(self.environ, self.start_response)
@@ -753,13 +890,14 @@ class AIDR(Service):
     def do(self, aid, binding, relay_state="", encrypt_cert=None):
         logger.info("--- Assertion ID Service ---")
 
+        _idp = IdpServerSettings_.IDP
         try:
-            assertion = IdpServerSettings_.IDP.create_assertion_id_request_response(aid)
+            assertion = _idp.create_assertion_id_request_response(aid)
         except Unknown:
             resp = NotFound(aid)
             return resp(self.environ, self.start_response)
 
-        hinfo = IdpServerSettings_.IDP.apply_binding(BINDING_URI, f"{assertion}", response=True)
+        hinfo = _idp.apply_binding(BINDING_URI, _to_xml_string(assertion), response=True)
 
         logger.debug("HINFO: %s", hinfo)
         resp = Response(hinfo["data"], headers=hinfo["headers"])
@@ -781,11 +919,12 @@ class AIDR(Service):
 
 class ARS(Service):
     def do(self, request, binding, relay_state="", encrypt_cert=None):
-        _req = IdpServerSettings_.IDP.parse_artifact_resolve(request, binding)
+        _idp = IdpServerSettings_.IDP
+        _req = _idp.parse_artifact_resolve(request, binding)
 
-        msg = IdpServerSettings_.IDP.create_artifact_response(_req, _req.artifact.text)
+        msg = _idp.create_artifact_response(_req, _req.artifact.text)
 
-        hinfo = IdpServerSettings_.IDP.apply_binding(BINDING_SOAP, f"{msg}", "", "", response=True)
+        hinfo = _idp.apply_binding(BINDING_SOAP, _to_xml_string(msg), "", "", response=True)
 
         resp = Response(hinfo["data"], headers=hinfo["headers"])
         return resp(self.environ, self.start_response)
@@ -800,14 +939,15 @@ class ARS(Service):
 class AQS(Service):
     def do(self, request, binding, relay_state="", encrypt_cert=None):
         logger.info("--- Authn Query Service ---")
-        _req = IdpServerSettings_.IDP.parse_authn_query(request, binding)
+        _idp = IdpServerSettings_.IDP
+        _req = _idp.parse_authn_query(request, binding)
         _query = _req.message
 
-        msg = IdpServerSettings_.IDP.create_authn_query_response(_query.subject,
-                                                                 _query.requested_authn_context, _query.session_index)
+        msg = _idp.create_authn_query_response(_query.subject,
+                                               _query.requested_authn_context, _query.session_index)
 
         logger.debug("response: %s", msg)
-        hinfo = IdpServerSettings_.IDP.apply_binding(BINDING_SOAP, f"{msg}", "", "", response=True)
+        hinfo = _idp.apply_binding(BINDING_SOAP, _to_xml_string(msg), "", "", response=True)
 
         resp = Response(hinfo["data"], headers=hinfo["headers"])
         return resp(self.environ, self.start_response)
@@ -823,7 +963,8 @@ class ATTR(Service):
     def do(self, request, binding, relay_state="", encrypt_cert=None):
         logger.info("--- Attribute Query Service ---")
 
-        _req = IdpServerSettings_.IDP.parse_attribute_query(request, binding)
+        _idp = IdpServerSettings_.IDP
+        _req = _idp.parse_attribute_query(request, binding)
         _query = _req.message
 
         name_id = _query.subject.name_id
@@ -832,11 +973,11 @@ class ATTR(Service):
         identity = EXTRA[uid]
 
         # Comes in over SOAP so only need to construct the response
-        args = IdpServerSettings_.IDP.response_args(_query, [BINDING_SOAP])
-        msg = IdpServerSettings_.IDP.create_attribute_response(identity, name_id=name_id, **args)
+        args = _idp.response_args(_query, [BINDING_SOAP])
+        msg = _idp.create_attribute_response(identity, name_id=name_id, **args)
 
         logger.debug("response: %s", msg)
-        hinfo = IdpServerSettings_.IDP.apply_binding(BINDING_SOAP, f"{msg}", "", "", response=True)
+        hinfo = _idp.apply_binding(BINDING_SOAP, _to_xml_string(msg), "", "", response=True)
 
         resp = Response(hinfo["data"], headers=hinfo["headers"])
         return resp(self.environ, self.start_response)
@@ -853,24 +994,22 @@ class ATTR(Service):
 
 class NIM(Service):
     def do(self, query, binding, relay_state="", encrypt_cert=None):
-        req = IdpServerSettings_.IDP.parse_name_id_mapping_request(query, binding)
+        _idp = IdpServerSettings_.IDP
+        req = _idp.parse_name_id_mapping_request(query, binding)
         request = req.message
         # Do the necessary stuff
         try:
-            name_id = IdpServerSettings_.IDP.ident.handle_name_id_mapping_request(
+            name_id = _idp.ident.handle_name_id_mapping_request(
                 request.name_id, request.name_id_policy)
-        except Unknown:
-            resp = BadRequest("Unknown entity")
-            return resp(self.environ, self.start_response)
-        except PolicyError:
+        except (Unknown, PolicyError):
             resp = BadRequest("Unknown entity")
             return resp(self.environ, self.start_response)
 
-        info = IdpServerSettings_.IDP.response_args(request)
-        _resp = IdpServerSettings_.IDP.create_name_id_mapping_response(name_id, **info)
+        info = _idp.response_args(request)
+        _resp = _idp.create_name_id_mapping_response(name_id, **info)
 
         # Only SOAP
-        hinfo = IdpServerSettings_.IDP.apply_binding(BINDING_SOAP, f"{_resp}", "", "", response=True)
+        hinfo = _idp.apply_binding(BINDING_SOAP, _to_xml_string(_resp), "", "", response=True)
 
         resp = Response(hinfo["data"], headers=hinfo["headers"])
         return resp(self.environ, self.start_response)
@@ -881,59 +1020,92 @@ class NIM(Service):
 # ----------------------------------------------------------------------------
 
 
-def info_from_cookie(kaka):
-    logger.debug("KAKA: %s", kaka)
-    if kaka:
-        cookie_obj = SimpleCookie(kaka)
-        morsel = cookie_obj.get("idpauthn", None)
-        if morsel:
-            try:
-                data = base64.b64decode(morsel.value)
+def _parse_cookie_header(header):
+    """
+    Parse a Cookie header into a dict with a single linear scan, first value wins.
+
+    This is purely a fast path for the plain name=value cookies handled here,
+    where SimpleCookie is considerably slower. Headers containing quoted values
+    still take the SimpleCookie path, so this offers no hardening against
+    crafted headers (cf. CVE-2024-7592 in CPython's http.cookies).
+    """
+    if '"' in header:
+        return {name: morsel.value for name, morsel in SimpleCookie(header).items()}
+    cookies = {}
+    for part in header.split(";"):
+        name, eq, value = part.partition("=")
+        if eq:
+            cookies.setdefault(name.strip(), value.strip())
+    return cookies
+
+
+def _cookies_from_environ(environ):
+    """Return the request cookies as a dict, parsing HTTP_COOKIE at most once.
+
+    The parsed dict is cached in the WSGI environ, so the cookie helpers can
+    be called several times during one request without re-parsing the header.
+    A containment test for the idpauthn cookie avoids parsing headers which
+    cannot be of interest to us at all.
+    """
+    parsed = environ.get("mss.parsed_cookie")
+    if parsed is None:
+        kaka = environ.get("HTTP_COOKIE", "")
+        parsed = _parse_cookie_header(kaka) if "idpauthn=" in kaka else {}
+        environ["mss.parsed_cookie"] = parsed
+    return parsed
+
+
+def info_from_cookie(environ):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("KAKA: %s", environ.get("HTTP_COOKIE"))
+    value = _cookies_from_environ(environ).get("idpauthn", None)
+    if value:
+        try:
+            if value.startswith("1:"):
+                data = unquote(value[2:])
+            else:
+                # cookie set before the URL-quoted format was introduced
+                data = base64.b64decode(value)
                 if not isinstance(data, str):
                     data = data.decode("ascii")
-                key, ref = data.split(":", 1)
-                return IdpServerSettings_.IDP.cache.uid2user[key], ref
-            except (KeyError, TypeError):
-                return None, None
-        else:
-            logger.debug("No idpauthn cookie")
+            key, ref = data.split(":", 1)
+            return IdpServerSettings_.IDP.cache.uid2user[key], ref
+        except (KeyError, TypeError):
+            return None, None
+    else:
+        logger.debug("No idpauthn cookie")
     return None, None
 
 
 def delete_cookie(environ, name):
     kaka = environ.get("HTTP_COOKIE", "")
-    logger.debug("delete KAKA: %s", kaka)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("delete KAKA: %s", kaka)
     if kaka:
-        cookie_obj = SimpleCookie(kaka)
-        morsel = cookie_obj.get(name, None)
-        cookie = SimpleCookie()
-        cookie[name] = ""
-        cookie[name]["path"] = "/"
-        logger.debug("Expire: %s", morsel)
-        cookie[name]["expires"] = _expiration("dawn")
-        return tuple(cookie.output().split(": ", 1))
+        morsel = _cookies_from_environ(environ).get(name, None)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Expire: %s", morsel)
+        return ("Set-Cookie", f"{name}=; Path=/; expires={_EXPIRE_DAWN}")
     return None
 
 
 def set_cookie(name, _, *args):
-    cookie = SimpleCookie()
+    # the attributes are fixed, so the header can be formatted directly
+    # without going through SimpleCookie and its morsels; the "1:" prefix
+    # marks the URL-quoted payload format (older cookies carried base64)
+    data = "1:" + quote(":".join(args), safe="")
+    expires = _expiration(5)  # 5 minutes from now
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Cookie expires: %s", expires)
+    return ("Set-Cookie", f"{name}={data}; Path=/; expires={expires}")
 
-    data = ":".join(args)
-    if not isinstance(data, bytes):
-        data = data.encode("ascii")
 
-    data64 = base64.b64encode(data)
-    if not isinstance(data64, str):
-        data64 = data64.decode("ascii")
+# ----------------------------------------------------------------------------
 
-    cookie[name] = data64
-    cookie[name]["path"] = "/"
-    cookie[name]["expires"] = _expiration(5)  # 5 minutes from now
-    logger.debug("Cookie expires: %s", cookie[name]["expires"])
-    return tuple(cookie.output().split(": ", 1))
 
-
-# ----------------------------------------------------------------------------
+def _static_route(environ, start_response, user):
+    # routed like the services but static files do not care about the user
+    return staticfile(environ, start_response)
 
 
 # map urls to functions
@@ -970,6 +1142,9 @@ AUTHN_URLS = [
     #
     (r"aqs$", (AQS, "soap")),
     (r"attr$", (ATTR, "soap")),
+    # kept last so service routes always win; also covers the no-user case
+    # through ALL_URLS
+    (r"static/.*$", _static_route),
 ]
 
 NON_AUTHN_URLS = [
@@ -978,29 +1153,89 @@ NON_AUTHN_URLS = [
     (r"sso/ecp$", (SSO, "ecp")),
 ]
 
+# compiled once at import so application() never goes through re._compile
+AUTHN_URLS = [(re.compile(regex), callback) for regex, callback in AUTHN_URLS]
+NON_AUTHN_URLS = [(re.compile(regex), callback) for regex, callback in NON_AUTHN_URLS]
+# non-authenticated routes first for requests without a user, prebuilt once
+ALL_URLS = NON_AUTHN_URLS + AUTHN_URLS
+
+
+def _combine_routes(urls):
+    """
+    Combine route patterns into one alternation regex plus dispatch tables.
+
+    Matching then costs a single regex engine invocation; the winning route
+    is recovered from match.lastindex by looking up the outer group number
+    each route starts at (routes with inner captures span several groups).
+    """
+    parts = []
+    routes = {}
+    starts = []
+    group = 1
+    for regex, callback in urls:
+        parts.append(f"({regex.pattern})")
+        routes[group] = (regex.groups, callback)
+        starts.append(group)
+        group += regex.groups + 1
+    return re.compile("|".join(parts)), routes, starts
+
+
+# a route pattern that, once the trailing $ is stripped, is a plain literal
+_LITERAL_ROUTE = re.compile(r"[A-Za-z0-9/_-]+\Z")
+
+
+def _split_routes(urls):
+    """
+    Split a URL table into an exact-string dict and the remaining regex routes.
+
+    Most routes are literal paths like ``sso/post``; for those a dict lookup
+    replaces the regex scan entirely. Routes with captures or metacharacters
+    stay on the regex side.
+    """
+    exact = {}
+    patterns = []
+    for regex, callback in urls:
+        literal = regex.pattern[:-1] if regex.pattern.endswith("$") else regex.pattern
+        if _LITERAL_ROUTE.match(literal):
+            exact[literal] = callback
+        else:
+            patterns.append((regex, callback))
+    return exact, patterns
+
+
+EXACT_AUTHN, _REGEX_AUTHN = _split_routes(AUTHN_URLS)
+EXACT_ALL, _REGEX_ALL = _split_routes(ALL_URLS)
+COMBINED_AUTHN = _combine_routes(_REGEX_AUTHN)
+COMBINED_ALL = _combine_routes(_REGEX_ALL)
+
 
 # ----------------------------------------------------------------------------
 
 
+# generated entity metadata is static for the process lifetime
+_METADATA_CACHE = None
+
+
 def metadata(environ, start_response):
+    global _METADATA_CACHE
     try:
-        path = IdpServerSettings_.args.path[:]
-        if path is None or len(path) == 0:
-            path = os.path.dirname(os.path.abspath(__file__))
-        if path[-1] != "/":
-            path += "/"
-        metadata = create_metadata_string(
-            path + IdpServerSettings_.args.config,
-            IdpServerSettings_.IDP.config,
-            IdpServerSettings_.args.valid,
-            IdpServerSettings_.args.cert,
-            IdpServerSettings_.args.keyfile,
-            IdpServerSettings_.args.id,
-            IdpServerSettings_.args.name,
-            IdpServerSettings_.args.sign,
-        )
+        if _METADATA_CACHE is None:
+            from saml2.metadata import create_metadata_string
+            metadata = create_metadata_string(
+                IdpServerSettings_.config_path,
+                IdpServerSettings_.IDP.config,
+                IdpServerSettings_.args.valid,
+                IdpServerSettings_.args.cert,
+                IdpServerSettings_.args.keyfile,
+                IdpServerSettings_.args.id,
+                IdpServerSettings_.args.name,
+                IdpServerSettings_.args.sign,
+            )
+            if not isinstance(metadata, bytes):
+                metadata = metadata.encode("utf-8")
+            _METADATA_CACHE = metadata
         start_response("200 OK", [("Content-Type", "text/xml")])
-        return [metadata]
+        return [_METADATA_CACHE]
     except Exception as ex:
         logger.error("An error occured while creating metadata: %s", ex.message)
         return not_found(environ, start_response)
@@ -1008,23 +1243,54 @@ def metadata(environ, start_response):
 
 def staticfile(environ, start_response):
     try:
-        path = IdpServerSettings_.args.path[:]
-        if path is None or len(path) == 0:
-            path = os.path.dirname(os.path.abspath(__file__))
-        if path[-1] != "/":
-            path += "/"
-        path += environ.get("PATH_INFO", "").lstrip("/")
-        path = os.path.realpath(path)
-        if not path.startswith(IdpServerSettings_.args.path):
+        static_root = IdpServerSettings_.static_root
+        # normpath collapses any ".." without the per-component stat calls
+        # realpath would make; the root itself was resolved at startup
+        path = os.path.normpath(static_root + environ.get("PATH_INFO", "").lstrip("/"))
+        if not path.startswith(static_root):
             resp = Unauthorized()
             return resp(environ, start_response)
-        start_response("200 OK", [("Content-Type", "text/xml")])
-        return open(path).read()
+        fobj = open(path, "rb")
+        size = os.fstat(fobj.fileno()).st_size
+        start_response("200 OK", [("Content-Type", "text/xml"),
+                                  ("Content-Length", str(size))])
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if file_wrapper is not None:
+            # lets the server push the open descriptor with sendfile(2)
+            return file_wrapper(fobj)
+        return iter(lambda: fobj.read(65536), b"")
     except Exception as ex:
         logger.error("An error occured while creating metadata: %s", ex.message)
         return not_found(environ, start_response)
 
 
+def _first_qs_value(qs, key):
+    """
+    Return the first value for ``key`` in a raw query string, or None.
+
+    Scans the string directly instead of building parse_qs' dict of lists
+    for a single-key lookup.
+    """
+    needle = key + "="
+    for part in qs.split("&"):
+        if part.startswith(needle):
+            return unquote_plus(part[len(needle):])
+    return None
+
+
+def _run_callback(callback, environ, start_response, user):
+    """Invoke a matched route callback, either a plain function or a
+    (service class, method name) tuple."""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Callback: %s", callback)
+    if isinstance(callback, tuple):
+        cls = callback[0](environ, start_response, user)
+        func = getattr(cls, callback[1])
+
+        return func()
+    return callback(environ, start_response, user)
+
+
 def application(environ, start_response):
     """
     The main WSGI application. Dispatch the current request to
@@ -1038,7 +1304,9 @@ def application(environ, start_response):
     :return: The response as a list of lines
     """
 
-    path = environ.get("PATH_INFO", "").lstrip("/")
+    path = environ.get("PATH_INFO", "")
+    if path.startswith("/"):
+        path = path[1:]
 
     if path == "idp.xml":
         return metadata(environ, start_response)
@@ -1048,41 +1316,45 @@ def application(environ, start_response):
 
     if kaka:
         logger.info("= KAKA =")
-        user, authn_ref = info_from_cookie(kaka)
+        user, authn_ref = info_from_cookie(environ)
         if authn_ref:
             environ["idp.authn"] = IdpServerSettings_.AUTHN_BROKER[authn_ref]
     else:
-        try:
-            query = parse_qs(environ["QUERY_STRING"])
-            logger.debug("QUERY: %s", query)
-            user = IdpServerSettings_.IDP.cache.uid2user[query["id"][0]]
-        except KeyError:
-            user = None
-
-    url_patterns = AUTHN_URLS
+        qs = environ.get("QUERY_STRING", "")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("QUERY: %s", qs)
+        uid = _first_qs_value(qs, "id") if qs else None
+        user = IdpServerSettings_.IDP.cache.uid2user.get(uid) if uid else None
+
+    exact = EXACT_AUTHN
+    combined, routes, starts = COMBINED_AUTHN
     if not user:
         logger.info("-- No USER --")
-        # insert NON_AUTHN_URLS first in case there is no user
-        url_patterns = NON_AUTHN_URLS + url_patterns
-
-    for regex, callback in url_patterns:
-        match = re.search(regex, path)
-        if match is not None:
-            try:
-                environ["myapp.url_args"] = match.groups()[0]
-            except IndexError:
-                environ["myapp.url_args"] = path
-
-            logger.debug("Callback: %s", callback)
-            if isinstance(callback, tuple):
-                cls = callback[0](environ, start_response, user)
-                func = getattr(cls, callback[1])
+        # NON_AUTHN_URLS come first in case there is no user
+        exact = EXACT_ALL
+        combined, routes, starts = COMBINED_ALL
+
+    # literal routes resolve with a dict lookup, no regex work at all
+    callback = exact.get(path)
+    if callback is not None:
+        environ["myapp.url_args"] = path
+        return _run_callback(callback, environ, start_response, user)
+
+    # match() anchors every alternation branch at the start of the path, so
+    # a non-matching route is rejected without scanning later positions
+    match = combined.match(path)
+    if match is not None:
+        # lastindex is the highest group that matched; the route it belongs
+        # to is the one with the largest outer group number not above it
+        start = starts[bisect.bisect_right(starts, match.lastindex) - 1]
+        inner_groups, callback = routes[start]
+        if inner_groups:
+            environ["myapp.url_args"] = match.group(start + 1)
+        else:
+            environ["myapp.url_args"] = path
 
-                return func()
-            return callback(environ, start_response, user)
+        return _run_callback(callback, environ, start_response, user)
 
-    if re.search(r"static/.*", path) is not None:
-        return staticfile(environ, start_response)
     return not_found(environ, start_response)
 
 
@@ -1093,12 +1365,18 @@ class IdpServerSettings:
         self.AUTHN_BROKER = AuthnBroker()
         self.IDP = None
         self.args = None
+        # normalized in main(), invariant afterwards
+        self.base_path = None
+        self.config_path = None
+        self.static_root = None
 
 
 IdpServerSettings_ = IdpServerSettings()
 
 
 def main():
+    import saml2.xmldsig as ds
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", dest="path", help="Path to configuration file.",
                         default="./idp_conf.py")
@@ -1117,6 +1395,18 @@ def main():
 
     IdpServerSettings_.args = parser.parse_args()
 
+    # normalize the base path once; metadata() and staticfile() only read it
+    _path = IdpServerSettings_.args.path
+    if not _path:
+        _path = os.path.dirname(os.path.abspath(__file__))
+    if not _path.endswith("/"):
+        _path += "/"
+    IdpServerSettings_.base_path = _path
+    IdpServerSettings_.config_path = _path + IdpServerSettings_.args.config
+    # resolved once so staticfile() can guard against traversal without
+    # calling os.path.realpath per request
+    IdpServerSettings_.static_root = os.path.realpath(_path) + os.sep
+
     try:
         CONFIG = importlib.import_module(IdpServerSettings_.args.config)
     except ImportError as e:
@@ -1128,29 +1418,24 @@ def main():
     IdpServerSettings_.AUTHN_BROKER.add(authn_context_class_ref(UNSPECIFIED), "", 0, CONFIG.BASE)
 
     IdpServerSettings_.IDP = server.Server(IdpServerSettings_.args.config, cache=Cache())
-    IdpServerSettings_.IDP.ticket = {}
+    IdpServerSettings_.IDP.ticket = collections.OrderedDict()
 
+    # read the configuration in one place; the algorithms are optional
     HOST = CONFIG.HOST
     PORT = CONFIG.PORT
-
-    sign_alg = None
-    digest_alg = None
-    try:
-        sign_alg = CONFIG.SIGN_ALG
-    except AttributeError:
-        pass
-    try:
-        digest_alg = CONFIG.DIGEST_ALG
-    except AttributeError:
-        pass
+    HTTPS = CONFIG.HTTPS
+    sign_alg = getattr(CONFIG, "SIGN_ALG", None)
+    digest_alg = getattr(CONFIG, "DIGEST_ALG", None)
     ds.DefaultSignature(sign_alg, digest_alg)
 
     ssl_context = None
     _https = ""
-    if CONFIG.HTTPS:
+    if HTTPS:
         _https = "using HTTPS"
-        # Creating an SSL context
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        # server-side context with secure defaults: TLS 1.3 when available,
+        # session resumption, and modern cipher selection
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
         ssl_context.load_cert_chain(CONFIG.SERVER_CERT, CONFIG.SERVER_KEY)
     SRV = WSGIServer(HOST, PORT, application, ssl_context=ssl_context)
 
@@ -55,6 +55,11 @@ class Test_Server_Auth_Not_Valid:
         assert authfunc("user", "testvaluepassword")
         assert authfunc("user", "wrong") is False
 
+    def test_settings_dict_exposes_overrides(self):
+        # the server reads this flag via mscolab_settings.__dict__.get, which
+        # has to see overrides even through the lazy settings proxy
+        assert mscolab_settings.__dict__.get("enable_basic_http_authentication", False) is True
+
     def test_verify_pw(self):
         assert verify_pw("user", "testvaluepassword")
         assert verify_pw("unknown", "unknow") is False